@@ -1,13 +1,26 @@
 from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
-from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.orm import sessionmaker, DeclarativeBase
+import orjson
 import os
 
-DATABASE_URL = os.getenv("DATABASE_URL", "postgresql://user:password@db:5432/savant_logs")
+DATABASE_URL = os.getenv("DATABASE_URL", "postgresql+psycopg://user:password@db:5432/savant_logs")
 
-engine = create_engine(DATABASE_URL)
+engine = create_engine(
+    DATABASE_URL,
+    pool_size=20,
+    max_overflow=40,
+    pool_pre_ping=True,
+    pool_recycle=1800,
+    insertmanyvalues_page_size=1000,
+    # Let psycopg3 switch to server-side prepared statements for hot queries
+    connect_args={"prepare_threshold": 5},
+    json_serializer=lambda obj: orjson.dumps(obj).decode("utf-8"),
+    json_deserializer=orjson.loads,
+)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
-Base = declarative_base()
+
+class Base(DeclarativeBase):
+    pass
 
 def init_db():
     # Import models here to ensure they're registered with Base
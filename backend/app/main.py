@@ -1,7 +1,11 @@
 from fastapi import FastAPI, UploadFile, File, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
+from sqlalchemy import func, insert, select
+from concurrent.futures import ProcessPoolExecutor
+import asyncio
 import tarfile
-import json
+import gzip
+import orjson
 import os
 from datetime import datetime
 from pathlib import Path
@@ -12,6 +16,8 @@ from .database import SessionLocal, init_db
 from .models import Project, LogCapture, Device, CrashReport
 import re
 import sqlite3
+import itertools
+import functools
 
 # Set up logging
 logging.basicConfig(level=logging.INFO)
@@ -21,6 +27,9 @@ logger = logging.getLogger(__name__)
 BASE_TEMP_DIR = Path("/tmp/savant_logs")
 BASE_TEMP_DIR.mkdir(exist_ok=True)
 
+# Worker pool for the CPU-heavy extraction/parsing stage of uploads
+executor = ProcessPoolExecutor(max_workers=os.cpu_count())
+
 app = FastAPI()
 
 @app.on_event("startup")
@@ -35,6 +44,7 @@ async def startup_event():
 
 @app.on_event("shutdown")
 async def shutdown_event():
+    executor.shutdown(wait=False)
     # Clean up temp directory on shutdown
     if BASE_TEMP_DIR.exists():
         shutil.rmtree(BASE_TEMP_DIR)
@@ -47,74 +57,284 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Insert rows in chunks to avoid building giant statements in memory
+BULK_INSERT_CHUNK_SIZE = 1000
+
+def bulk_insert_chunked(db, model, rows, chunk_size=BULK_INSERT_CHUNK_SIZE):
+    rows_iter = iter(rows)
+    while True:
+        chunk = list(itertools.islice(rows_iter, chunk_size))
+        if not chunk:
+            break
+        db.bulk_insert_mappings(model, chunk)
+
+# Copy the spooled upload to disk, zero-copy via sendfile when the
+# upload has rolled over to a real file descriptor
+def save_upload_to_disk(src, dest_path):
+    with open(dest_path, "wb") as buffer:
+        try:
+            in_fd = src.fileno()
+        except (OSError, ValueError, AttributeError):
+            shutil.copyfileobj(src, buffer, length=1024 * 1024)
+            return
+        size = os.fstat(in_fd).st_size
+        out_fd = buffer.fileno()
+        offset = 0
+        while offset < size:
+            sent = os.sendfile(out_fd, in_fd, offset, 8 * 1024 * 1024)
+            if sent == 0:
+                break
+            offset += sent
+
+# Crash report header patterns, compiled once at import time
+_PROCESS_RE = re.compile(r'Process:\s+(\w+)')
+_TIMESTAMP_RE = re.compile(r'Date/Time:\s+(.+)')
+_DEVICE_ID_RE = re.compile(r'Device ID: ([A-F0-9]+)')
+
+# Crashes in one capture often share the same second; strptime is slow
+# enough that caching the parse pays off
+@functools.lru_cache(maxsize=4096)
+def _parse_crash_ts(value):
+    return datetime.strptime(value, "%Y-%m-%d %H:%M:%S")
+
+# Crash report files start with one of these markers
+_CRASH_MAGIC = (b"Process:", b"Incident Identifier")
+# The header fields always sit in the first ~50 lines
+_CRASH_HEADER_SCAN_LINES = 50
+
 # Add this function to parse crash reports
 def parse_crash_report(crash_file_path):
     try:
-        with open(crash_file_path, 'r') as f:
-            content = f.read()
-            
-        # Extract basic info
-        process_match = re.search(r'Process:\s+(\w+)', content)
-        timestamp_match = re.search(r'Date/Time:\s+(.+)', content)
-        device_id_match = re.search(r'Device ID: ([A-F0-9]+)', content)
-        
+        with open(crash_file_path, 'rb', buffering=1024 * 1024) as f:
+            # Quick magic check - most device files aren't crash reports
+            if not f.read(32).startswith(_CRASH_MAGIC):
+                return None
+            f.seek(0)
+
+            # Scan the header line by line instead of reading the whole file
+            process = timestamp = device_id = None
+            for line_number, raw_line in enumerate(f):
+                if line_number >= _CRASH_HEADER_SCAN_LINES:
+                    break
+                line = raw_line.decode('utf-8', errors='replace')
+                if process is None:
+                    match = _PROCESS_RE.search(line)
+                    if match:
+                        process = match.group(1)
+                if timestamp is None:
+                    match = _TIMESTAMP_RE.search(line)
+                    if match:
+                        timestamp = match.group(1)
+                if device_id is None:
+                    match = _DEVICE_ID_RE.search(line)
+                    if match:
+                        device_id = match.group(1)
+                if process and timestamp and device_id:
+                    break
+
+            if process is None:
+                return None
+
+            # Only materialize the full content for an actual crash report
+            f.seek(0)
+            content = f.read().decode('utf-8', errors='replace')
+
         return {
-            'process': process_match.group(1) if process_match else 'unknown',
-            'timestamp': timestamp_match.group(1) if timestamp_match else None,
-            'device_id': device_id_match.group(1) if device_id_match else None,
+            'process': process,
+            'timestamp': timestamp,
+            'device_id': device_id,
             'content': content
         }
     except Exception as e:
         logger.error(f"Error parsing crash report {crash_file_path}: {str(e)}")
         return None
 
+# Find the logcapture-* directory without a full recursive walk
+def find_logcapture_dir(root):
+    # The directory sits at the top of the archive or one level down;
+    # scandir exposes is_dir() from the directory entry without an
+    # extra stat per path
+    with os.scandir(root) as entries:
+        subdirs = [entry for entry in entries if entry.is_dir()]
+    for entry in subdirs:
+        if entry.name.startswith("logcapture-"):
+            return Path(entry.path)
+    for parent in subdirs:
+        with os.scandir(parent.path) as entries:
+            for entry in entries:
+                if entry.is_dir() and entry.name.startswith("logcapture-"):
+                    return Path(entry.path)
+    return None
+
+# Raised by parse_upload in the worker; carries the status to report
+class UploadParseError(Exception):
+    def __init__(self, status_code, detail):
+        super().__init__(status_code, detail)
+        self.status_code = status_code
+        self.detail = detail
+
 # Add this function to parse lighting history
 def parse_lighting_history(db_path):
     try:
         conn = sqlite3.connect(db_path)
-        cursor = conn.cursor()
-        
-        # Get recent state changes
-        cursor.execute("""
-            SELECT device_id, state, timestamp 
-            FROM state_changes 
-            ORDER BY timestamp DESC 
-            LIMIT 1000
-        """)
-        
-        history = {}
-        for row in cursor.fetchall():
-            device_id, state, timestamp = row
-            if device_id not in history:
-                history[device_id] = []
-            history[device_id].append({
-                'state': state,
-                'timestamp': timestamp
-            })
-            
-        conn.close()
-        return history
+        try:
+            # Read-only access; mmap and a 64 MiB page cache avoid copying
+            # pages through sqlite's default small cache
+            conn.execute("PRAGMA mmap_size=268435456")
+            conn.execute("PRAGMA cache_size=-65536")
+            conn.execute("PRAGMA query_only=1")
+
+            # Get recent state changes: the inner query keeps the same
+            # 1000-most-recent cut as before, the outer sort just orders
+            # that set per device for grouping
+            cursor = conn.cursor()
+            cursor.arraysize = 1000
+            cursor.execute("""
+                SELECT device_id, state, timestamp
+                FROM (
+                    SELECT device_id, state, timestamp
+                    FROM state_changes
+                    ORDER BY timestamp DESC
+                    LIMIT 1000
+                )
+                ORDER BY device_id, timestamp DESC
+            """)
+            rows = cursor.fetchmany(1000)
+
+            history = {}
+            for device_id, grouped in itertools.groupby(rows, key=lambda row: row[0]):
+                history[device_id] = [
+                    {'state': state, 'timestamp': timestamp}
+                    for _, state, timestamp in grouped
+                ]
+            return history
+        finally:
+            conn.close()
     except Exception as e:
         logger.error(f"Error parsing lighting history: {str(e)}")
         return None
 
+# Runs in a worker process: extract the tarball and parse everything
+# CPU-bound, returning plain picklable row dicts. The caller fills in
+# log_capture_id and writes the rows to the database.
+def parse_upload(file_path, temp_dir):
+    file_path = Path(file_path)
+    temp_dir = Path(temp_dir)
+
+    # Extract the tar file in a single streaming pass with large read buffers
+    with open(file_path, "rb", buffering=1024 * 1024) as raw:
+        with gzip.GzipFile(fileobj=raw, mode="rb") as gz:
+            with tarfile.open(fileobj=gz, mode="r|") as tar:
+                tar.extractall(path=temp_dir)
+
+    # List extracted directory structure (debug only - re-stats every file)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Extracted directory structure:")
+        for path in temp_dir.rglob("*"):
+            logger.debug(f"  {path.relative_to(temp_dir)}")
+
+    # Find the logcapture directory
+    logcapture_dir = find_logcapture_dir(temp_dir)
+    if not logcapture_dir:
+        raise UploadParseError(400, "Could not find logcapture directory in uploaded file")
+    logger.info(f"Found logcapture directory: {logcapture_dir}")
+
+    network_devices_dir = logcapture_dir / "lighting" / "NetworkDevice"
+    system_health_dir = logcapture_dir / "lighting" / "SystemHealth"
+
+    logger.info(f"Looking for devices in: {network_devices_dir}")
+
+    if not network_devices_dir.exists():
+        raise UploadParseError(400, f"NetworkDevice directory not found at {network_devices_dir}")
+
+    # Lighting history is shared by every device - fetch it once per upload
+    lighting_history = None
+    lighting_db = logcapture_dir / "lighting" / "lightingHistory.sqlite"
+    if lighting_db.exists():
+        lighting_history = parse_lighting_history(lighting_db)
+
+    # WiFi and system stats are capture-wide files - read them once
+    wifi_data = None
+    wifi_file = logcapture_dir / "lighting" / "wifilist.out"
+    if wifi_file.exists():
+        wifi_data = wifi_file.read_text(encoding="utf-8", errors="replace")
+
+    system_stats = None
+    stats_file = logcapture_dir / "lighting" / "systemstats"
+    if stats_file.exists():
+        system_stats = stats_file.read_text(encoding="utf-8", errors="replace")
+
+    # Crash reports live in their own directory; NetworkDevice files are
+    # JSON state blobs and never parse as crashes
+    crash_reports = []
+    crash_rows = []
+    crashes_dir = logcapture_dir / "crashes"
+    if crashes_dir.exists():
+        for crash_file in crashes_dir.glob("*"):
+            crash_data = parse_crash_report(crash_file)
+            if crash_data:
+                crash_rows.append({
+                    'process_name': crash_data['process'],
+                    'timestamp': _parse_crash_ts(crash_data['timestamp']) if crash_data['timestamp'] else None,
+                    'crash_data': crash_data['content'],
+                    'related_device_id': crash_data['device_id']
+                })
+                crash_reports.append(crash_data)
+
+    device_rows = []
+    for device_file in network_devices_dir.glob("*"):
+        device_id = device_file.name
+        # Lazy %-formatting so disabled levels cost nothing per device
+        logger.info("Processing device: %s", device_id)
+
+        try:
+            network_data = orjson.loads(device_file.read_bytes())
+            logger.debug("Loaded network data for device: %s", device_id)
+
+            health_file = system_health_dir / device_id
+            health_data = None
+            if health_file.exists():
+                health_data = orjson.loads(health_file.read_bytes())
+                logger.debug("Loaded health data for device: %s", device_id)
+            else:
+                logger.warning("No health data found for device: %s", device_id)
+
+            # Add additional data
+            related_crashes = [cr for cr in crash_reports if cr['device_id'] == device_id]
+            device_history = lighting_history.get(device_id) if lighting_history else None
+
+            device_rows.append({
+                'device_id': device_id,
+                'network_data': network_data,
+                'health_data': health_data,
+                'related_crashes': related_crashes if related_crashes else None,
+                'lighting_history': device_history,
+                'system_stats': system_stats,
+                'wifi_data': wifi_data
+            })
+
+        except Exception as e:
+            logger.error(f"Error processing device {device_id}: {str(e)}")
+            raise UploadParseError(500, f"Error processing device {device_id}: {str(e)}")
+
+    return device_rows, crash_rows
+
 @app.post("/upload")
 async def upload_file(file: UploadFile = File(...)):
     # Create a unique temp directory for this upload
     temp_dir = BASE_TEMP_DIR / str(uuid.uuid4())
     temp_dir.mkdir(exist_ok=True)
-    
+
     try:
         # Save uploaded file
         file_path = temp_dir / file.filename
-        with open(file_path, "wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
-        
+        save_upload_to_disk(file.file, file_path)
+
         # Extract project name and timestamp from filename
         filename_parts = file.filename.replace("_DiagnosticReports.tgz", "").split('_')
         project_name = filename_parts[0]
         timestamp_str = filename_parts[1]
-        
+
         try:
             timestamp = datetime.strptime(timestamp_str, "%Y-%m-%d-%H%M%S")
         except ValueError:
@@ -122,149 +342,63 @@ async def upload_file(file: UploadFile = File(...)):
                 status_code=400,
                 detail=f"Invalid timestamp format in filename: {timestamp_str}"
             )
-        
-        # Extract the tar file
-        with tarfile.open(file_path, "r:gz") as tar:
-            # List contents before extraction
-            logger.info("Tar file contents:")
-            for member in tar.getmembers():
-                logger.info(f"  {member.name}")
-            tar.extractall(path=temp_dir)
-        
-        # List extracted directory structure
-        logger.info("Extracted directory structure:")
-        for path in temp_dir.rglob("*"):
-            logger.info(f"  {path.relative_to(temp_dir)}")
-        
+
+        # Extraction and parsing are CPU-bound - run them in a worker
+        # process so the event loop keeps serving other requests
+        loop = asyncio.get_running_loop()
+        try:
+            device_rows, crash_rows = await loop.run_in_executor(
+                executor, parse_upload, str(file_path), str(temp_dir))
+        except UploadParseError as e:
+            raise HTTPException(status_code=e.status_code, detail=e.detail)
+
         db = SessionLocal()
         try:
-            # Create or get project
-            project = db.query(Project).filter_by(name=project_name).first()
-            if not project:
-                project = Project(name=project_name)
-                db.add(project)
-                db.flush()
-            
-            # Create log capture
-            log_capture = LogCapture(
-                project_id=project.id,
-                timestamp=timestamp
-            )
-            db.add(log_capture)
-            db.flush()
-            
-            # Find the logcapture directory
-            possible_paths = list(temp_dir.rglob("logcapture-*"))
-            if not possible_paths:
-                raise HTTPException(
-                    status_code=400,
-                    detail="Could not find logcapture directory in uploaded file"
-                )
-            
-            logcapture_dir = possible_paths[0]
-            logger.info(f"Found logcapture directory: {logcapture_dir}")
-            
-            network_devices_dir = logcapture_dir / "lighting" / "NetworkDevice"
-            system_health_dir = logcapture_dir / "lighting" / "SystemHealth"
-            
-            logger.info(f"Looking for devices in: {network_devices_dir}")
-            
-            if not network_devices_dir.exists():
-                raise HTTPException(
-                    status_code=400,
-                    detail=f"NetworkDevice directory not found at {network_devices_dir}"
-                )
-            
-            device_count = 0
-            crash_reports = []
-            for device_file in network_devices_dir.glob("*"):
-                device_id = device_file.name
-                logger.info(f"Processing device: {device_id}")
-                
-                try:
-                    with open(device_file) as f:
-                        network_data = json.load(f)
-                    logger.info(f"Loaded network data for device: {device_id}")
-                    
-                    health_file = system_health_dir / device_id
-                    health_data = None
-                    if health_file.exists():
-                        with open(health_file) as f:
-                            health_data = json.load(f)
-                        logger.info(f"Loaded health data for device: {device_id}")
-                    else:
-                        logger.warning(f"No health data found for device: {device_id}")
-                    
-                    # Process crash reports
-                    crash_data = parse_crash_report(device_file)
-                    if crash_data:
-                        crash_report = CrashReport(
-                            log_capture_id=log_capture.id,
-                            process_name=crash_data['process'],
-                            timestamp=datetime.strptime(crash_data['timestamp'], "%Y-%m-%d %H:%M:%S") if crash_data['timestamp'] else None,
-                            crash_data=crash_data['content'],
-                            related_device_id=crash_data['device_id']
-                        )
-                        db.add(crash_report)
-                        crash_reports.append(crash_data)
-                    
-                    # Process lighting history
-                    lighting_history = None
-                    lighting_db = logcapture_dir / "lighting" / "lightingHistory.sqlite"
-                    if lighting_db.exists():
-                        lighting_history = parse_lighting_history(lighting_db)
-                    
-                    # Process WiFi data
-                    wifi_data = None
-                    wifi_file = logcapture_dir / "lighting" / "wifilist.out"
-                    if wifi_file.exists():
-                        with open(wifi_file) as f:
-                            wifi_data = f.read()
-                    
-                    # Process system stats
-                    system_stats = None
-                    stats_file = logcapture_dir / "lighting" / "systemstats"
-                    if stats_file.exists():
-                        with open(stats_file) as f:
-                            system_stats = f.read()
-                    
-                    # Add additional data
-                    related_crashes = [cr for cr in crash_reports if cr['device_id'] == device_id]
-                    device_history = lighting_history.get(device_id) if lighting_history else None
-                    
-                    device = Device(
-                        device_id=device_id,
-                        log_capture_id=log_capture.id,
-                        network_data=network_data,
-                        health_data=health_data,
-                        related_crashes=related_crashes if related_crashes else None,
-                        lighting_history=device_history,
-                        system_stats=system_stats,
-                        wifi_data=wifi_data
-                    )
-                    db.add(device)
-                    device_count += 1
-                    
-                except Exception as e:
-                    logger.error(f"Error processing device {device_id}: {str(e)}")
-                    raise HTTPException(
-                        status_code=500,
-                        detail=f"Error processing device {device_id}: {str(e)}"
-                    )
-            
-            db.commit()
+            # One transaction for the whole write path; ids come back from
+            # INSERT ... RETURNING so no intermediate flushes are needed
+            with db.begin():
+                # Create or get project
+                project_id = db.execute(
+                    select(Project.id).where(Project.name == project_name)
+                ).scalar_one_or_none()
+                if project_id is None:
+                    project_id = db.execute(
+                        insert(Project).values(name=project_name).returning(Project.id)
+                    ).scalar_one()
+
+                # Create log capture
+                log_capture_id = db.execute(
+                    insert(LogCapture)
+                    .values(project_id=project_id, timestamp=timestamp)
+                    .returning(LogCapture.id)
+                ).scalar_one()
+
+                # Attach the rows to the capture and write them in bulk
+                for row in device_rows:
+                    row['log_capture_id'] = log_capture_id
+                for row in crash_rows:
+                    row['log_capture_id'] = log_capture_id
+
+                bulk_insert_chunked(db, Device, device_rows)
+                bulk_insert_chunked(db, CrashReport, crash_rows)
+
+            device_count = len(device_rows)
             logger.info(f"Successfully processed {device_count} devices")
-            
+
             return {
                 "message": "File processed successfully",
                 "devices_processed": device_count,
                 "project_name": project_name,
                 "timestamp": timestamp.isoformat()
             }
-            
+
         finally:
             db.close()
-            
+
+    except HTTPException:
+        # Already carries the right status (e.g. 400s from filename or
+        # parse validation) - don't rewrap it as a 500
+        raise
     except Exception as e:
         logger.error(f"Upload error: {str(e)}")
         raise HTTPException(
@@ -272,9 +406,13 @@ async def upload_file(file: UploadFile = File(...)):
             detail=f"Error processing upload: {str(e)}"
         )
     finally:
-        # Clean up temp directory
+        # Clean up temp directory: atomically rename it out of the way,
+        # then run the slow recursive delete off the request path
         if temp_dir.exists():
-            shutil.rmtree(temp_dir)
+            trash_path = BASE_TEMP_DIR / f".trash-{uuid.uuid4()}"
+            os.rename(temp_dir, trash_path)
+            asyncio.create_task(
+                asyncio.to_thread(shutil.rmtree, trash_path, ignore_errors=True))
 
 @app.get("/projects")
 async def get_projects():
@@ -308,18 +446,25 @@ async def get_project_devices(project_id: int, capture_id: int = None):
             .order_by(LogCapture.timestamp.desc())\
             .first()
 
-        # Get current devices
+        # Get current devices, sorted in SQL - non-"found" states first
+        device_state = Device.network_data["state"].as_string()
         current_devices = db.query(Device)\
             .filter(Device.log_capture_id == current_capture.id)\
+            .order_by((device_state == "found").asc(), device_state.asc())\
             .all()
 
-        # Get previous devices if they exist
+        # Get previous devices if they exist - only the columns the diff
+        # needs, skipping the large wifi/stats/history JSON blobs
         previous_devices = {}
         if previous_capture:
-            prev_devices = db.query(Device)\
+            prev_devices = db.query(
+                    Device.device_id, Device.network_data, Device.health_data)\
                 .filter(Device.log_capture_id == previous_capture.id)\
                 .all()
-            previous_devices = {d.device_id: d for d in prev_devices}
+            previous_devices = {
+                device_id: (network_data, health_data)
+                for device_id, network_data, health_data in prev_devices
+            }
 
         # Prepare response with diff information
         result = []
@@ -337,21 +482,15 @@ async def get_project_devices(project_id: int, capture_id: int = None):
             
             # Add previous state if it exists
             if device.device_id in previous_devices:
-                prev_device = previous_devices[device.device_id]
+                prev_network_data, prev_health_data = previous_devices[device.device_id]
                 device_data["previous"] = {
-                    "network_data": prev_device.network_data,
-                    "health_data": prev_device.health_data,
+                    "network_data": prev_network_data,
+                    "health_data": prev_health_data,
                     "capture_timestamp": previous_capture.timestamp
                 }
             
             result.append(device_data)
 
-        # Sort by state - prioritize non-"found" states
-        result.sort(key=lambda x: (
-            x["current"]["network_data"].get("state", "") == "found",
-            x["current"]["network_data"].get("state", "")
-        ))
-
         return result
     finally:
         db.close()
@@ -364,17 +503,24 @@ async def get_project_stats(project_id: int):
         if not project:
             raise HTTPException(status_code=404, detail="Project not found")
             
-        captures = db.query(LogCapture).filter_by(project_id=project_id).all()
-        stats = []
-        
-        for capture in captures:
-            device_count = db.query(Device).filter_by(log_capture_id=capture.id).count()
-            stats.append({
-                "capture_id": capture.id,
-                "timestamp": capture.timestamp,
+        # Count devices per capture in a single join instead of one
+        # COUNT(*) round-trip per capture
+        rows = db.query(LogCapture.id, LogCapture.timestamp, func.count(Device.id))\
+            .outerjoin(Device, Device.log_capture_id == LogCapture.id)\
+            .filter(LogCapture.project_id == project_id)\
+            .group_by(LogCapture.id, LogCapture.timestamp)\
+            .all()
+
+        stats = [
+            {
+                "capture_id": capture_id,
+                "timestamp": timestamp,
                 "device_count": device_count
-            })
-            
+            }
+            for capture_id, timestamp, device_count in rows
+        ]
+
+
         return {
             "project_name": project.name,
             "captures": stats
@@ -1,41 +1,51 @@
 from datetime import datetime
-from sqlalchemy import Column, Integer, String, Float, DateTime, ForeignKey, JSON, Text
+from typing import Any, Optional
+from sqlalchemy import String, DateTime, ForeignKey, JSON, Text, Index
+from sqlalchemy.orm import Mapped, mapped_column
 from .database import Base
 
 class Project(Base):
     __tablename__ = "projects"
-    
-    id = Column(Integer, primary_key=True)
-    name = Column(String, unique=True)
-    created_at = Column(DateTime, default=datetime.utcnow)
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    name: Mapped[Optional[str]] = mapped_column(String, unique=True)
+    created_at: Mapped[Optional[datetime]] = mapped_column(DateTime, default=datetime.utcnow)
 
 class LogCapture(Base):
     __tablename__ = "log_captures"
-    
-    id = Column(Integer, primary_key=True)
-    project_id = Column(Integer, ForeignKey("projects.id"))
-    timestamp = Column(DateTime)
-    created_at = Column(DateTime, default=datetime.utcnow)
+    __table_args__ = (
+        # Services the "latest capture for project" ORDER BY timestamp DESC
+        Index("ix_capture_project_ts", "project_id", "timestamp"),
+    )
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    project_id: Mapped[Optional[int]] = mapped_column(ForeignKey("projects.id"), index=True)
+    timestamp: Mapped[Optional[datetime]] = mapped_column(DateTime)
+    created_at: Mapped[Optional[datetime]] = mapped_column(DateTime, default=datetime.utcnow)
 
 class Device(Base):
     __tablename__ = "devices"
-    
-    id = Column(Integer, primary_key=True)
-    device_id = Column(String)
-    log_capture_id = Column(Integer, ForeignKey("log_captures.id"))
-    network_data = Column(JSON)
-    health_data = Column(JSON)
-    related_crashes = Column(JSON)  # Store any crash data related to this device
-    lighting_history = Column(JSON)  # Store relevant lighting history
-    system_stats = Column(JSON)     # Store system stats at time of capture
-    wifi_data = Column(JSON)        # Store WiFi related data
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    device_id: Mapped[Optional[str]] = mapped_column(String, index=True)
+    log_capture_id: Mapped[Optional[int]] = mapped_column(ForeignKey("log_captures.id"), index=True)
+    network_data: Mapped[Optional[Any]] = mapped_column(JSON)
+    health_data: Mapped[Optional[Any]] = mapped_column(JSON)
+    related_crashes: Mapped[Optional[Any]] = mapped_column(JSON)  # Store any crash data related to this device
+    lighting_history: Mapped[Optional[Any]] = mapped_column(JSON)  # Store relevant lighting history
+    system_stats: Mapped[Optional[Any]] = mapped_column(JSON)     # Store system stats at time of capture
+    wifi_data: Mapped[Optional[Any]] = mapped_column(JSON)        # Store WiFi related data
+
+# Functional index backing the state sort in /project/{id}/devices; uses
+# the same as_string() expression as the query so Postgres can match it
+Index("ix_dev_state", Device.network_data["state"].as_string())
 
 class CrashReport(Base):
     __tablename__ = "crash_reports"
-    
-    id = Column(Integer, primary_key=True)
-    log_capture_id = Column(Integer, ForeignKey("log_captures.id"))
-    process_name = Column(String)
-    timestamp = Column(DateTime)
-    crash_data = Column(Text)
-    related_device_id = Column(String, nullable=True)  # Link to device if found in crash 
\ No newline at end of file
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    log_capture_id: Mapped[Optional[int]] = mapped_column(ForeignKey("log_captures.id"), index=True)
+    process_name: Mapped[Optional[str]] = mapped_column(String)
+    timestamp: Mapped[Optional[datetime]] = mapped_column(DateTime)
+    crash_data: Mapped[Optional[str]] = mapped_column(Text)
+    related_device_id: Mapped[Optional[str]] = mapped_column(String, nullable=True, index=True)  # Link to device if found in crash